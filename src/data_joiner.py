@@ -1,31 +1,38 @@
 """Loads cleaned GWAS data and combines it with extra data sources (allele frequency, tissue associations."""
 
-import re
-from os import listdir
-from typing import List, Set, Tuple
+from os import path, scandir
+from typing import Dict, List, Set
 
 import pandas as pd
 
 from dbsnp_api import get_afs_for_refsnps, print_progress_bar
 
+# pandas can parse CSVs with pyarrow's multithreaded reader, and read and write Parquet, when it is installed.
+try:
+    import pyarrow  # noqa: F401
+
+    HAS_PYARROW = True
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    HAS_PYARROW = False
+    CSV_ENGINE = "c"
+
 CLEAN_GWAS_DIR = "../data/gwas/clean/"
 AF_DIR = "../data/af/"
 GTEX_DIR = "../data/gtex/clean/"
 OUTPUT_DIR = "../data/joined/"
+# AF data fetched from dbSNP is cached as Parquet, or as CSV when pyarrow isn't installed.
+AF_CACHE_EXTENSION = ".parquet" if HAS_PYARROW else ".csv"
+# AFs of every SNP fetched from dbSNP so far, shared across traits.
+REFSNP_AF_CACHE_FILE = f"{AF_DIR}all_refsnps{AF_CACHE_EXTENSION}"
 
-# From https://www.ebi.ac.uk/gwas/docs/methods/curation
-# "? for unknown risk allele"
-UNKNOWN_ALLELE = "?"
 UNKNOWN_AF = -1.0
-ALLELE_REGEX_PATTERN = r"<b>(.*)</b>"
 
 # Separates distinct tissues in the to-be-added 'tissues' column.
 TISSUE_DELIM = "&"
 
-# Caches allele frequencies (AF) for alleles for each given SNP ID.
-afs_ = {}
-# Caches mappings from variants to sets of significantly associated tissues.
-variant_to_tissues_ = {}
+# AFs of every SNP fetched from dbSNP so far, keyed by SNP ID then allele. Loaded from REFSNP_AF_CACHE_FILE on first use.
+refsnp_afs_ = None
 
 
 def main() -> None:
@@ -37,25 +44,25 @@ def main() -> None:
 
 
 def get_input_trait_files_() -> List[str]:
-    files = listdir(CLEAN_GWAS_DIR)
-    return [file for file in files if ".csv" in file]
+    with scandir(CLEAN_GWAS_DIR) as entries:
+        return [entry.name for entry in entries if ".csv" in entry.name]
 
 
 def get_tissue_variant_files_() -> List[str]:
-    files = listdir(GTEX_DIR)
-    return [file for file in files if ".txt" in file]
+    with scandir(GTEX_DIR) as entries:
+        return [entry.name for entry in entries if ".txt" in entry.name]
 
 
 def process_file_(file_path: str) -> None:
     trait = get_trait_from_file_path_(file_path)
     print(f"Processing {trait} from {file_path}")
-    df = pd.read_csv(file_path)
+    df = pd.read_csv(file_path, engine=CSV_ENGINE)
 
     df = append_af_data_(df, trait)
     df = append_tissue_data_(df)
 
     output_file = f'{OUTPUT_DIR}{trait.replace(" ", "_")}.csv'
-    df.to_csv(output_file, index=False)
+    df.to_csv(output_file, index=False, chunksize=100_000)
     print(f"Wrote {output_file}")
 
 
@@ -70,74 +77,128 @@ def get_tissue_from_file_(file: str) -> str:
 
 
 def append_af_data_(input_df: pd.DataFrame, trait: str) -> pd.DataFrame:
-    """Looks up AF info for all variants and appends column 'af' with this data to a new DataFrame."""
-    out_df = input_df.copy()
-    trait_af_file = f'{trait.replace(" ", "_")}.csv'
-    if trait_af_file in listdir(AF_DIR):
+    """Looks up AF info for all variants and appends column 'af' with this data to the DataFrame."""
+    trait_af_file = f'{AF_DIR}{trait.replace(" ", "_")}{AF_CACHE_EXTENSION}'
+    # AF data cached before the switch to Parquet, or without pyarrow, is stored as CSV.
+    legacy_trait_af_file = f'{AF_DIR}{trait.replace(" ", "_")}.csv'
+    if path.exists(trait_af_file) or path.exists(legacy_trait_af_file):
         print(f"AF data cached, loading from file.")
-        af_df = pd.read_csv(f"{AF_DIR}{trait_af_file}")
-
-        out_df = out_df.merge(af_df, on="variant_and_allele")
-        return out_df
+        if HAS_PYARROW and path.exists(trait_af_file):
+            af_df = pd.read_parquet(trait_af_file, columns=["variant_and_allele", "af"])
+        else:
+            # Older ones were written with one row per mapped gene, so dedupe them before merging.
+            af_df = pd.read_csv(
+                legacy_trait_af_file,
+                usecols=["variant_and_allele", "af"],
+                dtype={"variant_and_allele": str, "af": "float64"},
+                engine=CSV_ENGINE,
+            ).drop_duplicates("variant_and_allele")
+
+        return input_df.merge(af_df, on="variant_and_allele")
 
     print(f"AF data not cached, loading from dbSNP.")
-    all_variants = out_df["variant_and_allele"].tolist()
-    rs_variants_and_alleles = [var for var in all_variants if "rs" in var]
-    rs_variants = [parse_variant_(var) for var in rs_variants_and_alleles]
-    global afs_
-    afs_ = {}
-
-    afs_ = get_afs_for_refsnps(rs_variants)
-    out_df["af"] = out_df["variant_and_allele"].map(try_get_af_for_variant_and_allele_)
+    # Given strings like 'rs1001780-<b>G</b>', fetch each distinct 'rs1001780' once.
+    variants_and_alleles = input_df["variant_and_allele"]
+    rs_variants = (
+        variants_and_alleles[variants_and_alleles.str.contains("rs", regex=False)]
+        .str.split("-", n=1)
+        .str[0]
+        .drop_duplicates()
+        .tolist()
+    )
+    # Only fetch SNPs which weren't already fetched for another trait.
+    global refsnp_afs_
+    if refsnp_afs_ is None:
+        refsnp_afs_ = read_refsnp_af_cache_()
+    uncached_rs_variants = [
+        variant for variant in rs_variants if variant not in refsnp_afs_
+    ]
+    print(f"{len(rs_variants) - len(uncached_rs_variants)} SNPs already fetched.")
+    if len(uncached_rs_variants) > 0:
+        refsnp_afs_.update(get_afs_for_refsnps(uncached_rs_variants))
+        write_refsnp_af_cache_(refsnp_afs_)
+
+    # Allele frequencies (AF) for alleles of each of this trait's SNP IDs.
+    afs = {
+        variant: refsnp_afs_[variant]
+        for variant in rs_variants
+        if variant in refsnp_afs_
+    }
+    input_df["af"] = lookup_afs_(input_df["variant_and_allele"], afs)
 
     # Cache dbSNP data to avoid lengthy API calls on re-runs.
-    maf_output_file = f'{AF_DIR}{trait.replace(" ", "_")}.csv'
-    out_df[["variant_and_allele", "af"]].to_csv(maf_output_file)
-    print(f"Wrote {maf_output_file}.")
-
-    return out_df
-
-
-def try_get_af_for_variant_and_allele_(variant_and_allele: str) -> float:
-    """Finds AF for input if it is known, otherwise returns UNKNOWN_AF."""
-    variant, allele = parse_variant_and_allele_(variant_and_allele)
-    if variant not in afs_:
-        return UNKNOWN_AF
-
-    var_afs = afs_[variant]
-    if allele == UNKNOWN_ALLELE or allele not in var_afs:
-        return UNKNOWN_AF
-
-    return var_afs[allele]
-
-
-def parse_variant_and_allele_(variant_and_allele: str) -> Tuple[str, str]:
-    """Given a string like 'rs1001780-<b>G</b>', returns ('rs1001780', 'G')."""
-    parts = variant_and_allele.split("-")
-    if len(parts) < 2:
-        return variant_and_allele, UNKNOWN_ALLELE
-    variant = parts[0]
-    allele_matches = re.findall(ALLELE_REGEX_PATTERN, parts[1], flags=0)
-    if len(allele_matches) == 0:
-        return variant, UNKNOWN_ALLELE
-    return variant, allele_matches[0]
-
-
-def parse_variant_(variant_and_allele: str) -> str:
-    """Given a string like 'rs1001780-<b>G</b>', returns 'rs1001780'."""
-    return parse_variant_and_allele_(variant_and_allele)[0]
+    # Variants repeat once per mapped gene, so keep one row each to avoid duplicating rows when merging it back.
+    af_df = input_df[["variant_and_allele", "af"]].drop_duplicates("variant_and_allele")
+    if HAS_PYARROW:
+        af_df.to_parquet(trait_af_file, index=False)
+    else:
+        af_df.to_csv(trait_af_file, index=False)
+    print(f"Wrote {trait_af_file}.")
+
+    return input_df
+
+
+def read_refsnp_af_cache_() -> Dict[str, Dict[str, float]]:
+    """Loads AFs previously fetched from dbSNP for any trait, keyed by SNP ID then allele."""
+    refsnp_afs = {}
+    if not path.exists(REFSNP_AF_CACHE_FILE):
+        return refsnp_afs
+
+    if HAS_PYARROW:
+        cache_df = pd.read_parquet(REFSNP_AF_CACHE_FILE)
+    else:
+        cache_df = pd.read_csv(
+            REFSNP_AF_CACHE_FILE,
+            dtype={"variant": str, "allele": str, "af": "float64"},
+            engine=CSV_ENGINE,
+        )
+    for variant, allele, af in cache_df.itertuples(index=False):
+        var_afs = refsnp_afs.setdefault(variant, {})
+        # Null alleles read back as None from Parquet, or NaN from CSV.
+        if not pd.isna(allele):
+            var_afs[allele] = af
+    return refsnp_afs
+
+
+def write_refsnp_af_cache_(refsnp_afs: Dict[str, Dict[str, float]]) -> None:
+    # SNPs without any AF data are stored with a null allele so they aren't fetched again.
+    rows = [
+        (variant, allele, af)
+        for variant, var_afs in refsnp_afs.items()
+        for allele, af in (var_afs.items() or [(None, None)])
+    ]
+    cache_df = pd.DataFrame(rows, columns=["variant", "allele", "af"])
+    if HAS_PYARROW:
+        cache_df.to_parquet(REFSNP_AF_CACHE_FILE, index=False)
+    else:
+        cache_df.to_csv(REFSNP_AF_CACHE_FILE, index=False)
+    print(f"Wrote {REFSNP_AF_CACHE_FILE}.")
+
+
+def lookup_afs_(
+    variants_and_alleles: pd.Series, afs: Dict[str, Dict[str, float]]
+) -> pd.Series:
+    """Finds AF for each 'variant-<b>allele</b>' value if it is known, otherwise UNKNOWN_AF.
+
+    Keys the lookup by the same 'variant-<b>allele</b>' strings so each row is a single dict probe.
+    """
+    af_lookup = {
+        f"{variant}-<b>{allele}</b>": af
+        for variant, var_afs in afs.items()
+        for allele, af in var_afs.items()
+    }
+    return variants_and_alleles.map(af_lookup).fillna(UNKNOWN_AF)
 
 
 def append_tissue_data_(df: pd.DataFrame) -> pd.DataFrame:
     """Determines tissue associations of all variants in the data frame.
 
     Opens processed tissue files which contain variants significantly associated with gene expression in those tissues,
-    finds matching variants in the data frame, and adds the matches to a new data frame.
+    finds matching variants in the data frame, and adds the matches as a new column.
     """
     variant_positions = set(df["location"])
     tissue_files = get_tissue_variant_files_()
-    global variant_to_tissues_
-    variant_to_tissues_ = {}
+    tissue_dfs = []
     print(f"Finding tissue associations...")
     for idx, tissue_file in enumerate(tissue_files):
         print_progress_bar(idx, len(tissue_files))
@@ -145,46 +206,41 @@ def append_tissue_data_(df: pd.DataFrame) -> pd.DataFrame:
         significant_tissue_variants = find_tissue_associations_(
             variant_positions, f"{GTEX_DIR}{tissue_file}"
         )
-        for variant in significant_tissue_variants:
-            if variant not in variant_to_tissues_:
-                variant_to_tissues_[variant] = set()
-            variant_to_tissues_[variant].add(tissue)
+        tissue_dfs.append(
+            pd.DataFrame(
+                {"location": list(significant_tissue_variants), "tissue": tissue}
+            )
+        )
 
     print_progress_bar(len(tissue_files), len(tissue_files))
     print("Writing associations to DF...")
-    out_df = df.copy()
-    out_df["tissues"] = out_df["location"].map(get_associated_tissues_)
-    return out_df
+    # Concatenated string of all tissues which each variant is associated with.
+    variant_to_tissues = (
+        pd.concat(tissue_dfs, ignore_index=True)
+        .groupby("location")["tissue"]
+        .agg(TISSUE_DELIM.join)
+    )
+    df["tissues"] = df["location"].map(variant_to_tissues).fillna("")
+    return df
 
 
-def gtex_location_to_gwas_location_(gtex_location: str) -> str:
-    """Converts variant locations in GWAS catalog format to GTEx format.
+def gtex_locations_to_gwas_locations_(gtex_locations: pd.Series) -> pd.Series:
+    """Converts variant locations in GTEx format to GWAS catalog format.
 
-    i.e. given 'chr1_64764_C_T_b38', returns '4:79296443'.
+    i.e. given 'chr4_79296443_C_T_b38', returns '4:79296443'.
     """
-    parts = gtex_location.split("_")
-    chr = parts[0][3]
-    return f"{chr}:{parts[1]}"
+    parts = gtex_locations.str.extract(r"^chr([^_]*)_([^_]*)")
+    return parts[0] + ":" + parts[1]
 
 
 def find_tissue_associations_(variant_pos_set: Set, tissue_filepath: str) -> Set[str]:
     """Identifies set of variants with significant tissue associations."""
-    tissue_associations = set()
-    with open(tissue_filepath) as tissue_file:
-        for variant_pos_with_allele in tissue_file.readlines():
-            gwas_variant_pos = gtex_location_to_gwas_location_(variant_pos_with_allele)
-            if gwas_variant_pos in variant_pos_set:
-                tissue_associations.add(gwas_variant_pos)
-    return tissue_associations
-
-
-def get_associated_tissues_(variant_location: str) -> str:
-    """Returns concatenated string of all tissues which this variant is associated with."""
-    if variant_location not in variant_to_tissues_:
-        return ""
-
-    tissues_set = variant_to_tissues_[variant_location]
-    return TISSUE_DELIM.join(tissues_set)
+    gtex_locations = pd.read_csv(
+        tissue_filepath, header=None, names=["location"], dtype=str, engine=CSV_ENGINE
+    )["location"]
+    gwas_locations = gtex_locations_to_gwas_locations_(gtex_locations)
+    return set(gwas_locations[gwas_locations.isin(variant_pos_set)])
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,93 @@
 """Utilities for retrieving data from dbSNP."""
 
 import json
-import time
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List
 
 import requests
+from requests.adapters import HTTPAdapter
 
 DB_SNP = "snp"
 
 # dbsnp efetch max refsnp results:
 MAX_DBSNP_QUERIES = 15
 
-# dbsnp API min time between requests.
-SLEEP_SECONDS = 3
+# dbsnp API max requests per second (without an API key).
+MAX_REQUESTS_PER_SECOND = 3
+# Seconds before a request slot is reused. A bit over a second leaves headroom for network
+# jitter, since the server counts requests when they arrive rather than when they start.
+REQUEST_SLOT_SECONDS = 1.2
 
 SUBCOL_DELIM = ";"
 
 # Use this study for reporting population mean allele frequency (MAF).
 PREFERED_AF_STUDY = "dbGaP_PopFreq"
 
+# Shared across requests so the connection to NCBI is kept alive between batches.
+session_ = requests.Session()
+session_.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+# Each request takes a slot, which is handed back REQUEST_SLOT_SECONDS later.
+request_slots_ = threading.Semaphore(MAX_REQUESTS_PER_SECOND)
+# Filled length of the last printed progress bar, to skip redrawing an unchanged bar.
+last_progress_bar_filled_length_ = -1
+
 
 def get_afs_for_refsnps(snp_ids: List[str]) -> Dict[str, Dict[str, float]]:
     """Given a dbSNP ID, fetches allele frequency data about the SNP from dbSNP.
     Returns a dict of dicts, where outer key is SNP ID, inner dict key is allele, and value is MAF for that allele for
     that SNP. dbSNP API has some rate limiting features that make it a bit tedious and slow to work with...
     """
-    start = 0
-    stop = len(snp_ids)
+    batches = [
+        snp_ids[start : start + MAX_DBSNP_QUERIES]
+        for start in range(0, len(snp_ids), MAX_DBSNP_QUERIES)
+    ]
     data = {}
-    # A batch may retrieve invalid JSON. If this happens, store the IDs and retry them afterwards one by one,
-    # skipping any in the batch that have invalid JSON individually.
+    # A batch may retrieve invalid JSON or an error (e.g. when rate limited). If this happens, store the IDs and
+    # retry them afterwards one by one, skipping any in the batch that fail individually.
     retry_ids = []
     failed_id_count = 0
     print(f"Retrieving data from dbSNP...")
-    while start < stop:
-        cutoff = start + MAX_DBSNP_QUERIES
-        cutoff = min(stop, cutoff)
-        batch_ids = snp_ids[start:cutoff]
-
-        print_progress_bar_(start + 1, stop)
-
-        time.sleep(SLEEP_SECONDS)
-        try:
-            data_batch = get_afs_for_refsnps_internal_(batch_ids)
-            # Pythonic way to merge dicts (3.5+)
-            data = {**data, **data_batch}
-        except json.decoder.JSONDecodeError:
-            retry_ids = retry_ids + batch_ids
-
-        start += MAX_DBSNP_QUERIES
-
-    print_progress_bar_(stop, stop)
-    if len(retry_ids) > 0:
-        print(f"Retrying {len(retry_ids)} SNPs...")
-
-    for retry_id in retry_ids:
-        try:
-            data_batch = get_afs_for_refsnps_internal_([retry_id])
-            # Pythonic way to merge dicts (3.5+)
-            data = {**data, **data_batch}
-        except json.decoder.JSONDecodeError:
-            # Just accept that we won't have this SNP.
-            failed_id_count += 1
+    with ThreadPoolExecutor(max_workers=MAX_REQUESTS_PER_SECOND) as executor:
+        batch_futures = {
+            executor.submit(get_afs_for_refsnps_rate_limited_, batch_ids): batch_ids
+            for batch_ids in batches
+        }
+        for idx, future in enumerate(as_completed(batch_futures)):
+            try:
+                data.update(future.result())
+            except (json.decoder.JSONDecodeError, requests.RequestException):
+                retry_ids.extend(batch_futures[future])
+            print_progress_bar(idx + 1, len(batches))
+
+        if len(retry_ids) > 0:
+            print(f"Retrying {len(retry_ids)} SNPs...")
+
+        retry_futures = [
+            executor.submit(get_afs_for_refsnps_rate_limited_, [retry_id])
+            for retry_id in retry_ids
+        ]
+        for future in as_completed(retry_futures):
+            try:
+                data.update(future.result())
+            except (json.decoder.JSONDecodeError, requests.RequestException):
+                # Just accept that we won't have this SNP.
+                failed_id_count += 1
 
     if failed_id_count > 0:
-        print(f"Unable to parse response for {failed_id_count} SNPs")
+        print(f"Unable to retrieve data for {failed_id_count} SNPs")
     return data
 
 
+def get_afs_for_refsnps_rate_limited_(
+    snp_ids: List[str],
+) -> Dict[str, Dict[str, float]]:
+    """Waits for a free request slot so no more than MAX_REQUESTS_PER_SECOND requests start each second."""
+    request_slots_.acquire()
+    threading.Timer(REQUEST_SLOT_SECONDS, request_slots_.release).start()
+    return get_afs_for_refsnps_internal_(snp_ids)
+
+
 def get_afs_for_refsnps_internal_(snp_ids: List[str]) -> Dict[str, Dict[str, float]]:
     """Makes API call and parses response. Wrapped to avoid exceeding API request/response size limitations."""
     url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
@@ -79,41 +99,64 @@ def get_afs_for_refsnps_internal_(snp_ids: List[str]) -> Dict[str, Dict[str, flo
     }
 
     maf_dicts = {}
-    request = requests.get(url=url, params=params)
-    parseable_json = (
-        "[{" + request.text[1:].replace('{"refsnp_id":', ',{"refsnp_id":') + "]"
-    )
-    response = json.loads(parseable_json)
-    for snp_response in response:
-        if "primary_snapshot_data" not in snp_response:
-            continue
-
-        snp_id = "rs" + snp_response["refsnp_id"]
-        allele_to_maf = {}
-        allele_annotations = snp_response["primary_snapshot_data"]["allele_annotations"]
-        for allele_annotation in allele_annotations:
-            frequencies = allele_annotation["frequency"]
-            pop_freq_entries = [
-                entry
-                for entry in frequencies
-                if entry["study_name"] == PREFERED_AF_STUDY
-            ]
-            if len(pop_freq_entries) == 0:
+    with session_.get(url=url, params=params, stream=True) as request:
+        # e.g. 429 when rate limited.
+        request.raise_for_status()
+        for snp_response in iter_snp_responses_(request):
+            # Errors may also be reported in the body, e.g. {"error":"API rate limit exceeded",...}.
+            if "error" in snp_response:
+                raise requests.HTTPError(snp_response["error"], response=request)
+            if "primary_snapshot_data" not in snp_response:
                 continue
-            pop_freq_entry = pop_freq_entries[0]
-            pop_maf = pop_freq_entry["allele_count"] / pop_freq_entry["total_count"]
-            allele = pop_freq_entry["observation"]["inserted_sequence"]
-            allele_to_maf[allele] = pop_maf
-        # Sometimes all alleles are reported, even with 0.0 values.
-        # Drop those, assuming they are truly 0 and should be ignored.
-        allele_to_maf = {
-            key: value for key, value in allele_to_maf.items() if value > 0.0
-        }
-        maf_dicts[snp_id] = allele_to_maf
+
+            snp_id = "rs" + snp_response["refsnp_id"]
+            allele_to_maf = {}
+            allele_annotations = snp_response["primary_snapshot_data"][
+                "allele_annotations"
+            ]
+            for allele_annotation in allele_annotations:
+                frequencies = allele_annotation["frequency"]
+                pop_freq_entry = next(
+                    (
+                        entry
+                        for entry in frequencies
+                        if entry["study_name"] == PREFERED_AF_STUDY
+                    ),
+                    None,
+                )
+                if pop_freq_entry is None:
+                    continue
+                pop_maf = pop_freq_entry["allele_count"] / pop_freq_entry["total_count"]
+                allele = pop_freq_entry["observation"]["inserted_sequence"]
+                allele_to_maf[allele] = pop_maf
+            # Sometimes all alleles are reported, even with 0.0 values.
+            # Drop those, assuming they are truly 0 and should be ignored.
+            allele_to_maf = {
+                key: value for key, value in allele_to_maf.items() if value > 0.0
+            }
+            maf_dicts[snp_id] = allele_to_maf
 
     return maf_dicts
 
 
+def iter_snp_responses_(request: requests.Response) -> Iterator[Dict]:
+    """Yields each SNP's JSON object from a streamed efetch response, one at a time.
+
+    The response usually has one object per line, but back-to-back objects on a line are handled too.
+    """
+    decoder = json.JSONDecoder()
+    for line in request.iter_lines():
+        text = line.decode("utf-8")
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos == len(text):
+                break
+            snp_response, pos = decoder.raw_decode(text, pos)
+            yield snp_response
+
+
 # From https://stackoverflow.com/questions/3173320/text-progress-bar-in-terminal-with-block-characters
 def print_progress_bar(
     iteration: int,
@@ -137,8 +180,13 @@ def print_progress_bar(
         fill        - Optional  : bar fill character (Str)
         print_end    - Optional  : end character (e.g. "\r", "\r\n") (Str)
     """
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
+    global last_progress_bar_filled_length_
     filled_length = int(length * iteration // total)
+    if 0 < iteration < total and filled_length == last_progress_bar_filled_length_:
+        return
+    last_progress_bar_filled_length_ = filled_length
+
+    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     bar = fill * filled_length + "-" * (length - filled_length)
     print(f"\r{prefix} |{bar}| {percent}% {suffix}", end=print_end)
     # Print New Line on Complete
@@ -1,10 +1,26 @@
 """Generates normalized versions of summary statistics for traits from GWAS Catalog."""
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from os import listdir
 from typing import List, Set
 
 import pandas as pd
 
+# pandas can parse CSVs with pyarrow's multithreaded reader, keep string columns in
+# contiguous Arrow arrays rather than as Python objects, and write Parquet when it is installed.
+try:
+    import pyarrow  # noqa: F401
+
+    HAS_PYARROW = True
+    CSV_ENGINE = "pyarrow"
+    STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    HAS_PYARROW = False
+    CSV_ENGINE = "c"
+    STRING_DTYPE = str
+
 # Input file directory.
 INPUT_DIR = "../data/gwas/raw/"
 OUTPUT_DIR = "../data/gwas/clean/"
@@ -15,6 +31,18 @@ OUTPUT_DIR = "../data/gwas/clean/"
 TRAIT_FILE_SUFFIX = "_gwas_catalog_2022.csv"
 METADATA_FILE_PATH = "../data/gwas/gwas_trait_metadata.csv"
 
+# Input file columns used for cleaning, all read as strings.
+INPUT_COLUMNS = [
+    "Variant and risk allele",
+    "P-value",
+    "Trait(s)",
+    "Mapped gene",
+    "Location",
+]
+
+# Max rows of an input file to parse at once.
+INPUT_CHUNK_ROWS = 2**18
+
 UNKNOWN_GENE = "UNKNOWN"
 CHILD_TRAIT_DELIMITER = ";"
 # Some variants report this value in 'Variant and risk allele', and have no location information.
@@ -29,9 +57,30 @@ NON_RSVAR_FORMAT_LOCATION_VALUE = "Mapping not available"
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="re-clean traits which already have an output file",
+    )
+    args = parser.parse_args()
+
     trait_files = get_input_trait_files_()
-    for input_file in trait_files:
-        process_file_(INPUT_DIR + input_file)
+    if not args.force:
+        done = get_cleaned_traits_()
+        num_trait_files = len(trait_files)
+        trait_files = [
+            f
+            for f in trait_files
+            if get_trait_from_file_path_(INPUT_DIR + f) not in done
+        ]
+        print(
+            f"Skipping {num_trait_files - len(trait_files)} already cleaned traits, use --force to redo."
+        )
+    # Trait files are independent, so clean them in parallel.
+    with ProcessPoolExecutor() as executor:
+        # Consume the results so any worker exceptions are raised here.
+        list(executor.map(process_file_, [INPUT_DIR + f for f in trait_files]))
 
     print("Done")
 
@@ -42,6 +91,15 @@ def get_input_trait_files_() -> List[str]:
     return trait_files
 
 
+def get_cleaned_traits_() -> Set[str]:
+    """Finds traits which already have an output file from a previous run."""
+    return {
+        f[: -len(".csv")].replace("_", " ")
+        for f in listdir(OUTPUT_DIR)
+        if f.endswith(".csv")
+    }
+
+
 def process_file_(input_file_path: str) -> None:
     main_trait = get_trait_from_file_path_(input_file_path)
     traits_to_retain = get_child_traits_(main_trait)
@@ -53,14 +111,17 @@ def process_file_(input_file_path: str) -> None:
 
 
 def get_child_traits_(main_trait: str) -> Set[str]:
-    metadata_df = pd.read_csv(METADATA_FILE_PATH)
-    trait_row = metadata_df.loc[metadata_df["Trait"] == main_trait]
-    traits = (
-        trait_row["Child traits"].astype(str).tolist()[0].split(CHILD_TRAIT_DELIMITER)
-    )
+    child_traits = get_trait_metadata_().at[main_trait, "Child traits"]
+    traits = str(child_traits).split(CHILD_TRAIT_DELIMITER)
     return set(map(normalize_trait_name_, traits))
 
 
+@lru_cache(maxsize=None)
+def get_trait_metadata_() -> pd.DataFrame:
+    """Reads the trait metadata file once, indexed by trait."""
+    return pd.read_csv(METADATA_FILE_PATH, engine=CSV_ENGINE).set_index("Trait")
+
+
 def get_trait_from_file_path_(file_path: str) -> str:
     file_name = file_path[len(INPUT_DIR) :]
     trait = file_name.split(TRAIT_FILE_SUFFIX)[0].replace("_", " ")
@@ -68,15 +129,32 @@ def get_trait_from_file_path_(file_path: str) -> str:
 
 
 def clean_file_(input_file_path: str, traits_to_retain: Set[str]) -> pd.DataFrame:
-    df = pd.read_csv(input_file_path)
-
-    # Parse P-values as numbers.
-    df["P-value_norm"] = df["P-value"].apply(pval_to_num_)
-
-    # Filter to only records with the canonical trait.
-    # It's important this step occurs before the gene normalization
-    # as that step intentionally creates duplicate variant entries.
-    df = filter_by_traits_(df, traits_to_retain)
+    # Read in chunks so only rows with a retained trait are held in memory at once.
+    # (The pyarrow engine doesn't support chunked reads.)
+    original_total_rows = 0
+    filtered_chunks = []
+    for chunk in pd.read_csv(
+        input_file_path,
+        usecols=INPUT_COLUMNS,
+        dtype=STRING_DTYPE,
+        engine="c",
+        chunksize=INPUT_CHUNK_ROWS,
+    ):
+        original_total_rows += len(chunk)
+
+        # Parse P-values as numbers.
+        chunk["P-value_norm"] = pvals_to_nums_(chunk["P-value"])
+
+        # Filter to only records with the canonical trait.
+        # It's important this step occurs before the gene normalization
+        # as that step intentionally creates duplicate variant entries.
+        filtered_chunks.append(filter_by_traits_(chunk, traits_to_retain))
+
+    df = pd.concat(filtered_chunks)
+    filtered_rows = original_total_rows - len(df)
+    print(
+        f"Trait filtering removed {filtered_rows} rows ({original_total_rows} originally)."
+    )
 
     # Sanity-check that all duplicated variants have same mapped-gene value.
     sanity_check_duplicate_variants_(df)
@@ -85,24 +163,36 @@ def clean_file_(input_file_path: str, traits_to_retain: Set[str]) -> pd.DataFram
     df = df[df["Variant and risk allele"] != BAD_VARIANT_VALUE]
 
     # Remove duplicate variants by taking only the one with lowest p-value.
-    df = df.sort_values("P-value_norm").drop_duplicates(
-        "Variant and risk allele", keep="first"
+    lowest_pval_rows = (
+        df["P-value_norm"]
+        .fillna(float("inf"))
+        .groupby(df["Variant and risk allele"], sort=False)
+        .idxmin()
     )
+    df = df.loc[lowest_pval_rows].sort_values("P-value_norm", kind="stable")
 
     # Normalize 'Mapped gene' column by creating an extra row for each individual gene
     # (some have multiple).
     df = normalize_mapped_genes_(df)
 
     # Populate location field for variants where 'Variant and risk allele' actually reports location.
-    df["Location"] = df.apply(try_fix_variant_location_, axis=1)
+    df["Location"] = try_fix_variant_locations_(df)
+
+    # Genes and variants repeat across rows, so store them as categories like 'Trait(s)'.
+    for column in ["Variant and risk allele", "gene_norm"]:
+        df[column] = df[column].astype("category")
 
     return df
 
 
-def pval_to_num_(pval: str) -> float:
+def pvals_to_nums_(pvals: pd.Series) -> pd.Series:
     """P-values are reported as strings; convert to numbers for easier processing."""
-    parts = pval.split(" x 10-")
-    return float(parts[0]) * pow(10, -float(parts[1]))
+    parts = pvals.str.split(" x 10-", n=1, expand=True).reindex(columns=[0, 1])
+    mantissas = parts[0].astype("float64")
+    exponents = parts[1].fillna("0").astype("float64")
+    # Few distinct exponents exist, so compute each power once; np.power can differ from pow in the last bit.
+    scales = {exponent: pow(10, -exponent) for exponent in exponents.unique()}
+    return mantissas * exponents.map(scales)
 
 
 def normalize_trait_name_(trait: str) -> str:
@@ -113,72 +203,60 @@ def normalize_trait_name_(trait: str) -> str:
 def filter_by_traits_(df: pd.DataFrame, traits_to_retain: Set[str]) -> pd.DataFrame:
     """Filters the DataFrame such that only rows with trait value in the given list are kept."""
     # First normalize trait column (un-capitalize)
-    df["Trait(s)"] = df["Trait(s)"].map(normalize_trait_name_)
-    original_total_rows = len(df)
-    df["is_retained_trait"] = df["Trait(s)"].map(lambda t: t in traits_to_retain)
-    filtered_df = df[df["is_retained_trait"] == True]
-    filtered_rows = len(df) - len(filtered_df)
-    print(
-        f"Trait filtering removed {filtered_rows} rows ({original_total_rows} originally)."
-    )
-    return filtered_df
+    traits = df["Trait(s)"].str.strip().str.lower()
+    is_retained_trait = traits.isin(traits_to_retain)
+    # Only a handful of traits are retained, so store them as categories of just those traits.
+    # The categories are fixed so that filtered chunks stay categorical when concatenated.
+    retained_trait_dtype = pd.CategoricalDtype(sorted(traits_to_retain))
+    df["Trait(s)"] = traits.where(is_retained_trait).astype(retained_trait_dtype)
+    return df[is_retained_trait]
 
 
 def sanity_check_duplicate_variants_(df: pd.DataFrame) -> None:
-    duplicate_variants = (
-        df.groupby("Variant and risk allele")
-        .filter(lambda x: len(x) > 1)["Variant and risk allele"]
-        .unique()
-    )
-    all_good = True
-    for variant in duplicate_variants:
-        all_mapped_genes = df[df["Variant and risk allele"] == variant][
-            "Mapped gene"
-        ].unique()
-        if len(all_mapped_genes) > 1:
-            print(f"Found variant, {variant}, with differing mapped gene values.")
-            all_good = False
-
-    if all_good:
+    mapped_gene_counts = df.groupby("Variant and risk allele", sort=False)[
+        "Mapped gene"
+    ].nunique(dropna=False)
+    bad_variants = mapped_gene_counts.index[mapped_gene_counts > 1]
+    for variant in bad_variants:
+        print(f"Found variant, {variant}, with differing mapped gene values.")
+
+    if len(bad_variants) == 0:
         print("No repeated variants with differing mapped gene values.")
 
 
 def normalize_mapped_genes_(df: pd.DataFrame) -> pd.DataFrame:
-    df["gene_norm"] = df["Mapped gene"].apply(lambda val: val.split(", "))
+    df["gene_norm"] = df["Mapped gene"].str.split(", ")
     df = df.explode("gene_norm")
-    df["gene_norm"] = df["gene_norm"].apply(replace_unknown_gene_)
+    # I'm pretty sure '- indicates unknown gene association.
+    df["gene_norm"] = df["gene_norm"].replace("'-", UNKNOWN_GENE)
     return df
 
 
-def replace_unknown_gene_(gene: str) -> str:
-    """I'm pretty sure '- indicates unknown gene association."""
-    return UNKNOWN_GENE if gene == "'-" else gene
-
+def try_fix_variant_locations_(df: pd.DataFrame) -> pd.Series:
+    """Tries setting location values if not specified but can be derived from variant column.
 
-def try_fix_variant_location_(variant_row: pd.Series) -> str:
-    """Tries setting location value if not specified but can be derived from variant column.
-
-    For example, given a variant of form 'chr6:55564517-<b>?</b>' returns '6:55564517'.
+    For example, given a variant of form 'chr6:55564517-<b>?</b>' sets '6:55564517'.
     Some are also in form 'chr7_140700006_I-<b>?</b>'.
     """
-    if variant_row["Location"] != NON_RSVAR_FORMAT_LOCATION_VALUE:
-        return variant_row["Location"]
-
-    variant = variant_row["Variant and risk allele"]
-
-    if "rs" in variant or "chr" not in variant:
-        return NON_RSVAR_FORMAT_LOCATION_VALUE
-
-    if "chr" in variant and ":" in variant:
-        parts = variant.split(":")
-        chr_num = parts[0][3]
-        location = parts[1].split("-")[0]
-        return f"{chr_num}:{location}"
+    locations = df["Location"]
+    variants = df["Variant and risk allele"]
 
-    parts = variant.split("_")
-    chr_num = parts[0][3]
-    location = parts[1]
-    return f"{chr_num}:{location}"
+    needs_fix = (
+        (locations == NON_RSVAR_FORMAT_LOCATION_VALUE)
+        & ~variants.str.contains("rs", regex=False, na=False)
+        & variants.str.contains("chr", regex=False, na=False)
+    )
+    is_colon_format = needs_fix & variants.str.contains(":", regex=False, na=False)
+    is_underscore_format = needs_fix & ~is_colon_format
+
+    # Chromosome follows 'chr' up to the first separator, position runs up to the next separator or '-'.
+    colon_parts = variants.str.extract(r"^chr([^:]*):([^:-]*)")
+    underscore_parts = variants.str.extract(r"^chr([^_]*)_([^_-]*)")
+    return locations.mask(
+        is_colon_format, colon_parts[0].str.cat(colon_parts[1], sep=":")
+    ).mask(
+        is_underscore_format, underscore_parts[0].str.cat(underscore_parts[1], sep=":")
+    )
 
 
 def write_to_file_(trait: str, df: pd.DataFrame) -> None:
@@ -202,8 +280,15 @@ def write_to_file_(trait: str, df: pd.DataFrame) -> None:
     out_df = out_df.rename(columns=column_remapping)
 
     output_file = f'{OUTPUT_DIR}{trait.replace(" ", "_")}.csv'
-    out_df.to_csv(output_file, index=False)
+    out_df.to_csv(output_file, index=False, chunksize=100_000)
     print(f"Wrote {output_file}.")
 
+    # Also write a typed, compressed copy which is much faster to load than the CSV.
+    if HAS_PYARROW:
+        parquet_file = output_file.replace(".csv", ".parquet")
+        out_df.to_parquet(parquet_file, compression="zstd", index=False)
+        print(f"Wrote {parquet_file}.")
+
 
-main()
+if __name__ == "__main__":
+    main()